@@ -13,6 +13,9 @@ import time
 # argparse module used for providing command-line interface
 import argparse
 
+# Regular expressions used to validate the API version argument
+import re
+
 # Prometheus modules for HTTP server & metrics
 from prometheus_client import start_http_server, Summary
 from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
@@ -21,6 +24,44 @@ from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGIS
 import queue
 import threading
 
+# Profiling modules used by the optional debug endpoint
+import cProfile
+import pstats
+import tracemalloc
+import io
+import os
+import sys
+from collections import Counter
+
+# Standard library HTTP server for the debug endpoint, kept separate from the metrics server
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Render the exposition format so a profile covers the whole scrape, not only collect()
+from prometheus_client import CollectorRegistry, generate_latest
+
+
+# API version used when the controller doesn't report which versions it supports
+DEFAULT_API_VERSION = 'v9_0'
+
+# Number of items requested per page for list endpoints
+DEFAULT_PAGE_SIZE = 1000
+
+# HTTP status codes returned by SmartZone when an API version or endpoint isn't available
+# 400 is left out on purpose, SmartZone also uses it for ordinary bad requests
+VERSION_REJECTED_STATUS = (404, 405)
+
+
+# Turn an API version string like 'v9_1' into a tuple (9, 1) so versions sort correctly
+def api_version_key(version):
+    return tuple(int(x) for x in version.lstrip('v').split('_'))
+
+
+# Check whether a failed request means "try an older API version" rather than a real error
+def is_version_rejected(error):
+    return isinstance(error, requests.HTTPError) and error.response is not None \
+        and error.response.status_code in VERSION_REJECTED_STATUS
+
 
 # Create SmartZoneCollector as a class - in Python3, classes inherit object as a base class
 # Only need to specify for compatibility or in Python2
@@ -29,40 +70,131 @@ class SmartZoneCollector():
 
     # Initialize the class and specify required argument with no default value
     # When defining class methods, must explicitly list `self` as first argument
-    def __init__(self, target, user, password, insecure):
+    def __init__(self, target, user, password, insecure, api_version=None):
         # Strip any trailing "/" characters from the provided url
         self._target = target.rstrip("/")
         # Take these arguments as provided, no changes needed
         self._user = user
         self._password = password
         self._insecure = insecure
+        # Optional API version pinned from the command line, skips negotiation
+        self._pinned_api_version = api_version
 
         self._headers = None
         self._statuses = None
 
+        # API versions supported by the controller, newest first, filled by negotiate_api()
+        self._api_versions = []
+        # Whether the controller actually answered apiInfo, otherwise negotiation is retried next collection
+        self._api_negotiated = False
+        # Capability cache: section -> API version that worked last time
+        self._capabilities = {}
+        # Firmware versions of the controller nodes seen during the last collection, used to detect upgrades
+        self._controller_versions = None
+
+        # Renegotiation after all versions are rejected happens at most once per collection
+        self._renegotiated = False
+
         # With the exception of uptime, all of these metrics are strings
         # Following the example of node_exporter, we'll set these string metrics with a default value of 1
 
-    def get_session(self):
-        # Disable insecure request warnings if SSL verification is disabled
+    def copy(self):
+        # Build a separate collector for the same controller, so it can run alongside live scrapes
+        # without sharing per-collection state like `_statuses` or `_headers`
+        # Learned API versions and capabilities are copied so it behaves like the live collector
+        c = SmartZoneCollector(self._target, self._user, self._password, self._insecure, self._pinned_api_version)
+        c._api_versions = list(self._api_versions)
+        c._api_negotiated = self._api_negotiated
+        c._capabilities = dict(self._capabilities)
+        c._controller_versions = self._controller_versions
+        return c
+
+    def negotiate_api(self):
+        # Disable insecure request warnings if SSL verification is disabled, this runs before get_session()
         if self._insecure == False:
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-        # Session object used to keep persistent cookies and connection pooling
-        s = requests.Session()
-
-        # Set `verify` variable to enable or disable SSL checking
-        # Use string method format methods to create new string with inserted value (in this case, the URL)
-        s.get('{}/wsg/api/public/v9_0/session'.format(self._target), verify=self._insecure)
-
-        # Define URL arguments as a dictionary of strings 'payload'
-        payload = {'username': self._user, 'password': self._password}
-
-        # Call the payload using the json parameter
-        r = s.post('{}/wsg/api/public/v9_0/session'.format(self._target), json=payload, verify=self._insecure)
+        # Ask the controller which API versions it supports, apiInfo doesn't need a session
+        negotiated = True
+        if self._pinned_api_version:
+            versions = [self._pinned_api_version]
+        else:
+            try:
+                r = requests.get('{}/wsg/api/public/apiInfo'.format(self._target), verify=self._insecure)
+                r.raise_for_status()
+                versions = json.loads(r.text).get('apiSupportVersions', [])
+            except (requests.RequestException, ValueError) as e:
+                # Use the default version for now and ask again on the next collection
+                print('Failed to get supported API versions: {}'.format(e))
+                versions = []
+                negotiated = False
+
+        # Keep only versions we can parse and order them newest first
+        parsed = []
+        for v in versions:
+            try:
+                parsed.append((api_version_key(v), v))
+            except ValueError:
+                continue
+        self._api_versions = [v for _, v in sorted(parsed, reverse=True)] or [DEFAULT_API_VERSION]
+
+        # Forget the capabilities learned from the previous controller version
+        self._capabilities = {}
+        self._api_negotiated = negotiated
+        print('Using SmartZone API {}'.format(self._api_versions[0]))
+
+    def renegotiate(self):
+        # Called when login or a fixed API path is rejected in every version we know of, e.g. after an upgrade
+        # Only runs from the collection thread, AP worker threads never renegotiate or replace the session
+        # Returns True when the caller should retry with the refreshed versions and session
+        if self._pinned_api_version or self._renegotiated:
+            return False
+        self._renegotiated = True
+
+        # Keep the learned capabilities if the controller still reports the same versions
+        versions, capabilities = self._api_versions, self._capabilities
+        self.negotiate_api()
+        if self._api_versions == versions:
+            self._capabilities = capabilities
+        self.get_session(retry=False)
+        return True
+
+    def get_session(self, retry=True):
+        # Disable insecure request warnings if SSL verification is disabled
+        if self._insecure == False:
+            requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-        # Raise bad requests
-        r.raise_for_status()
+        # Log in with the newest supported API version, falling back to older ones if it's rejected
+        rejected = None
+        for version in self._api_versions:
+            # Session object used to keep persistent cookies and connection pooling
+            s = requests.Session()
+
+            # Set `verify` variable to enable or disable SSL checking
+            # Use string method format methods to create new string with inserted value (in this case, the URL)
+            s.get('{}/wsg/api/public/{}/session'.format(self._target, version), verify=self._insecure)
+
+            # Define URL arguments as a dictionary of strings 'payload'
+            payload = {'username': self._user, 'password': self._password}
+
+            # Call the payload using the json parameter
+            r = s.post('{}/wsg/api/public/{}/session'.format(self._target, version), json=payload,
+                       verify=self._insecure)
+
+            # Raise bad requests, unless the version was rejected and there is an older one left to try
+            try:
+                r.raise_for_status()
+            except requests.HTTPError as e:
+                if is_version_rejected(e):
+                    rejected = e
+                    continue
+                raise
+            break
+        else:
+            # Every version was rejected, the controller may have been upgraded, so ask it again once
+            if retry and self.renegotiate():
+                return
+            raise rejected
 
         # Create a dictionary from the cookie name-value pair, then get the value based on the JSESSIONID key
         session_id = r.cookies.get_dict().get('JSESSIONID')
@@ -71,21 +203,72 @@ class SmartZoneCollector():
         # Integrate the session ID into the header
         self._headers = {'Content-Type': 'application/json;charset=UTF-8', 'Cookie': 'JSESSIONID={}'.format(session_id)}
 
-    def get_metrics(self, metrics, api_path):
-        # Add the individual URL paths for the API call
-        self._statuses = list(metrics.keys())
+    def fetch(self, version, api_path):
+        url = '{}/wsg/api/public/{}/{}'.format(self._target, version, api_path)
         if 'query' in api_path:
             # For APs, use POST and API query to reduce number of requests and improve performance
-            # To-do: set dynamic AP limit based on SmartZone inventory
-            raw = {'page': 0, 'start': 0, 'limit': 1000}
-            r = requests.post('{}/wsg/api/public/v9_0/{}'.format(self._target, api_path), json=raw,
-                              headers=self._headers, verify=self._insecure)
-        else:
-            r = requests.get('{}/wsg/api/public/v9_0/{}'.format(self._target, api_path + '?listSize=1000'),
-                             headers=self._headers,
-                             verify=self._insecure)
-        result = json.loads(r.text)
-        return result
+            raw = {'page': 0, 'start': 0, 'limit': DEFAULT_PAGE_SIZE}
+            r = requests.post(url, json=raw, headers=self._headers, verify=self._insecure)
+            r.raise_for_status()
+            return json.loads(r.text)
+
+        # Follow `hasMore` so lists bigger than one page are returned complete
+        result = None
+        params = {'listSize': DEFAULT_PAGE_SIZE}
+        while True:
+            r = requests.get(url, params=params, headers=self._headers, verify=self._insecure)
+            r.raise_for_status()
+            page = json.loads(r.text)
+            if result is None:
+                result = page
+            elif page.get('firstIndex') != params['index']:
+                # The endpoint ignored `index`, stop instead of appending the same items again
+                return result
+            else:
+                result['list'].extend(page['list'])
+
+            # Only ask for the next page when we can tell where it starts, so the index always moves forward
+            if not (isinstance(page, dict) and page.get('hasMore') and page.get('list') and 'firstIndex' in page):
+                return result
+            if 'totalCount' in page and len(result['list']) >= page['totalCount']:
+                return result
+            params['index'] = page['firstIndex'] + len(page['list'])
+
+    def get_metrics(self, metrics, api_path, section=None, retry=True):
+        # Add the individual URL paths for the API call
+        self._statuses = list(metrics.keys())
+
+        # Section is the cache key, paths containing IDs pass a generic name instead
+        # A 404 on a path with an ID can just mean the resource is gone, so only fixed paths can tell
+        # that the whole API version was rejected
+        fixed_path = section is None
+        section = section or api_path
+
+        # Once a version has worked for this section, stick to it, a 404 now means the resource is missing
+        # (e.g. an AP removed since the `aps` list call) rather than the version being rejected
+        # Upgrades are picked up by get_session() failures and the controller version check in collect()
+        cached = self._capabilities.get(section)
+        if cached:
+            return self.fetch(cached, api_path)
+
+        # Otherwise try the supported versions newest first
+        rejected = None
+        for version in self._api_versions:
+            try:
+                result = self.fetch(version, api_path)
+            except requests.HTTPError as e:
+                # Only fall back when the version is rejected, other errors are real failures
+                if is_version_rejected(e):
+                    rejected = e
+                    continue
+                raise
+            self._capabilities[section] = version
+            return result
+
+        # Every version rejected a fixed path, the controller may have been upgraded, so ask it again once
+        if retry and fixed_path and self.renegotiate():
+            return self.get_metrics(metrics, api_path, retry=False)
+        raise rejected
 
     def collect(self):
 
@@ -480,12 +663,21 @@ class SmartZoneCollector():
                                   labels=["license_name", "expireDate"])
         }
 
+        # Allow one renegotiation per collection if the controller rejects every known version
+        self._renegotiated = False
+
+        # Detect supported API versions on the first collection, or retry if the controller didn't answer
+        if not self._api_negotiated:
+            self.negotiate_api()
+
         self.get_session()
 
         id = 0
+        versions = set()
         # Get SmartZone controller metrics
         for c in self.get_metrics(controller_metrics, 'controller')['list']:
             id = c['id']
+            versions.add(str(c.get('version')))
             for s in self._statuses:
                 if s == 'uptimeInSec':
                     controller_metrics[s].add_metric([id], c.get(s))
@@ -497,10 +689,18 @@ class SmartZoneCollector():
         for m in controller_metrics.values():
             yield m
 
+        # Refresh the capability cache when the controller has been upgraded
+        # Compare all node versions, so the check doesn't depend on the order of nodes in a cluster
+        versions = sorted(versions)
+        if self._controller_versions is not None and versions != self._controller_versions:
+            self.negotiate_api()
+            self.get_session()
+        self._controller_versions = versions
+
         # Get SmartZone system metric
 
         path = 'controller/' + id + '/statistics'
-        system = self.get_metrics(system_metric, path)
+        system = self.get_metrics(system_metric, path, 'controller/statistics')
         for c in system_metric:
             varList = list(system_metric[c].keys())
             for s in varList:
@@ -566,8 +766,13 @@ class SmartZoneCollector():
                 if item is None:
                     break
                 path = 'aps/' + item + '/operational/summary'
-                r.put(self.get_metrics(ap_metrics, path))
-                q.task_done()
+                # Always mark the task done, otherwise a failed request would block q.join() forever
+                try:
+                    r.put(self.get_metrics(ap_metrics, path, 'aps/operational/summary'))
+                except (requests.RequestException, ValueError) as e:
+                    print('Failed to get {}: {}'.format(path, e))
+                finally:
+                    q.task_done()
 
         # Queue for threads
         q = queue.Queue()
@@ -652,6 +857,161 @@ class SmartZoneCollector():
             yield m
 
 
+# Upper bound for a single stack sampling request, so one request can't occupy the debug server forever
+MAX_SAMPLE_SECONDS = 60
+
+# Lower bound for the sampling interval, a tighter loop would hold the GIL against the scrape being measured
+MIN_SAMPLE_INTERVAL = 0.001
+
+# Valid pstats sort keys including aliases accepted by sort_stats(), e.g. cumulative, tottime, ncalls
+PROFILE_SORT_KEYS = set(pstats.Stats.sort_arg_dict_default)
+
+
+# Run one full collection cycle under cProfile and tracemalloc and return a text report
+def profile_collection(collector, sort='cumulative', limit=40):
+    # Profile a copy of the collector, so an overlapping live scrape can't have its state changed mid-cycle
+    # Register it in a private registry so the cycle also includes exposition rendering,
+    # exactly like a real scrape, without touching the global REGISTRY
+    registry = CollectorRegistry()
+    registry.register(collector.copy())
+
+    # Only stop tracemalloc afterwards if it wasn't already running
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    # cProfile only instruments the calling thread, so time spent in the AP worker threads
+    # shows up as waiting in queue.join(); use /debug/sample to see inside the workers
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        profiler.enable()
+        try:
+            output = generate_latest(registry)
+        finally:
+            profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    duration = time.time() - start
+
+    report = io.StringIO()
+    report.write('Collection cycle took {:.3f}s and rendered {} bytes of metrics\n\n'.format(duration, len(output)))
+
+    report.write('== cProfile, sorted by {}, top {} ==\n'.format(sort, limit))
+    pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+
+    # Hide the allocations made by tracemalloc itself
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    report.write('== tracemalloc, top {} allocations by line ==\n'.format(limit))
+    for stat in snapshot.statistics('lineno')[:limit]:
+        report.write('{}\n'.format(stat))
+
+    return report.getvalue()
+
+
+# Periodically capture the stack of every other thread and count identical stacks
+# Output is in the collapsed stack format ("thread;frame;frame count") read by flamegraph.pl and speedscope
+def sample_stacks(seconds, interval=0.01):
+    own_ident = threading.get_ident()
+    stacks = Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+# HTTP handler for the debug endpoint
+# - /debug/profile?sort=cumulative&limit=40 runs one collection cycle under cProfile and tracemalloc
+# - /debug/sample?seconds=10&interval=0.01 samples all running threads and returns collapsed stacks
+class DebugHandler(BaseHTTPRequestHandler):
+
+    # Collector instance is attached by start_debug_server()
+    collector = None
+
+    # Only allow one run at a time, they are expensive and would skew each other's results
+    lock = threading.Lock()
+
+    def send_text(self, code, body):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if url.path not in ('/debug/profile', '/debug/sample'):
+            self.send_text(404, 'Not found, use /debug/profile or /debug/sample\n')
+            return
+
+        # Validate the query parameters before doing any work
+        try:
+            if url.path == '/debug/profile':
+                sort = params.get('sort', ['cumulative'])[0]
+                limit = int(params.get('limit', ['40'])[0])
+                if sort not in PROFILE_SORT_KEYS or limit <= 0:
+                    raise ValueError('sort must be one of {} and limit must be positive'.format(
+                        ', '.join(sorted(PROFILE_SORT_KEYS))))
+            else:
+                seconds = float(params.get('seconds', ['10'])[0])
+                interval = float(params.get('interval', ['0.01'])[0])
+                if not 0 < seconds <= MAX_SAMPLE_SECONDS or interval < MIN_SAMPLE_INTERVAL:
+                    raise ValueError('seconds must be between 0 and {} and interval at least {}'.format(
+                        MAX_SAMPLE_SECONDS, MIN_SAMPLE_INTERVAL))
+        except ValueError as e:
+            self.send_text(400, 'Bad request: {}\n'.format(e))
+            return
+
+        if not self.lock.acquire(blocking=False):
+            self.send_text(409, 'Another profiling run is in progress\n')
+            return
+        try:
+            if url.path == '/debug/profile':
+                body = profile_collection(self.collector, sort, limit)
+            else:
+                body = sample_stacks(seconds, interval)
+        except Exception as e:
+            self.send_text(500, 'Profiling failed: {!r}\n'.format(e))
+            return
+        finally:
+            self.lock.release()
+        self.send_text(200, body)
+
+
+# Start the debug HTTP server in a background thread
+def start_debug_server(collector, address, port):
+    DebugHandler.collector = collector
+    server = ThreadingHTTPServer((address, port), DebugHandler)
+    t = threading.Thread(target=server.serve_forever, name='debug-server', daemon=True)
+    t.start()
+    return server
+
+
+# Validate an API version argument like v9_0, so a typo fails at startup instead of being ignored
+def api_version_arg(value):
+    if not re.fullmatch(r'v\d+_\d+', value):
+        raise argparse.ArgumentTypeError("invalid API version '{}', expected v<major>_<minor>, e.g. v9_0".format(value))
+    return value
+
+
 # Function to parse command line arguments and pass them to the collector
 def parse_args():
     parser = argparse.ArgumentParser(description='Ruckus SmartZone exporter for Prometheus')
@@ -669,10 +1029,20 @@ def parse_args():
     # Add store_false action to store true/false values, and set a default of True
     parser.add_argument('--insecure', action='store_false', help='Allow insecure SSL connections to Smartzone')
 
+    # Pin the SmartZone API version instead of detecting it, e.g. v9_0
+    parser.add_argument('--api-version', type=api_version_arg, default=None,
+                        help='SmartZone API version to use, e.g. v9_0 (default=newest supported by the controller)')
+
     # Specify integer type for the listening port
     parser.add_argument('--port', type=int, default=9345,
                         help='Port on which to expose metrics and web interface (default=9345)')
 
+    # Debug endpoint is disabled unless a port is given, and only listens on localhost by default
+    parser.add_argument('--debug-port', type=int, default=None,
+                        help='Port on which to expose the /debug/profile and /debug/sample endpoints (default=disabled)')
+    parser.add_argument('--debug-address', default='127.0.0.1',
+                        help='Address on which the debug endpoint listens (default=127.0.0.1)')
+
     # Now that we've added the arguments, parse them and return the values as output
     return parser.parse_args()
 
@@ -681,9 +1051,14 @@ def main():
     try:
         args = parse_args()
         port = int(args.port)
-        REGISTRY.register(SmartZoneCollector(args.target, args.user, args.password, args.insecure))
+        collector = SmartZoneCollector(args.target, args.user, args.password, args.insecure, args.api_version)
+        REGISTRY.register(collector)
         # Start HTTP server on specified port
         start_http_server(port)
+        # Start the debug server only when explicitly requested
+        if args.debug_port is not None:
+            start_debug_server(collector, args.debug_address, args.debug_port)
+            print("Debug endpoint listening on {}:{}".format(args.debug_address, args.debug_port))
         if args.insecure == False:
             print('WARNING: Connection to {} may not be secure.'.format(args.target))
         print("Polling {}. Listening on ::{}".format(args.target, port))